@@ -2,9 +2,11 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import boto3
+import functools
 import json
 import logging
 import os
+import random
 import re
 import time
 
@@ -16,10 +18,13 @@ ATTR_PI_PT_COL=11
 LAST_PARENT_IDX=8
 
 LOGGER = logging.getLogger()
-LOGGER.setLevel(logging.INFO)
+## LOG_LEVEL takes a standard level name in any case, unknown names mean INFO.
+LOG_LEVEL = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO').upper())
+LOGGER.setLevel(LOG_LEVEL if isinstance(LOG_LEVEL, int) else logging.INFO)
 
-def log(message):
-    LOGGER.info(message)
+## Arguments are %-formatted by logging, only when INFO is enabled.
+def log(message, *args):
+    LOGGER.info(message, *args)
 
 # Log non 200 responses or non api responses
 def api_report(response):
@@ -29,12 +34,14 @@ def api_report(response):
         if s:
             c = int(s)
             if c != 200:
-                log("Error: " + str(response))
+                log("Error: %s", response)
         else:
-            log(str(response))
+            log("%s", response)
     else:
-        log(str(response))
+        log("%s", response)
 
+## One session per process, creating it loads the service data files.
+@functools.lru_cache(maxsize=1)
 def boto3_session(profile = 'default', region = 'us-east-1'):
     s = boto3.Session(
         #profile_name = profile if profile else os.environ.get('AWS_PROFILE'),
@@ -50,26 +57,35 @@ def get_role_from_identity():
     ws_arn = "/".join(identt.get('Arn').split("/")[:-1])
     return re.sub(r":sts:",":iam:",re.sub('assumed-','',ws_arn))
 
+## Longest sleep between polls of a backing off wait_over.
+MAX_HOP = 2.0
+
 ## Custom waiter, sort of...
 ## jq python cannot handle datetime, so using this function
 ## only supports nested dicts, no support for list yet.
+## With backoff the hop doubles after every poll, capped at MAX_HOP seconds,
+## each sleep is jittered so parallel waiters do not poll in lockstep, and
+## timeout is counted in seconds slept instead of polls.
 def wait_over(aws_api, api_params, nested_jq_path,
-                    expected_value, timeout=30, hop=1):
-    if timeout <= 0:
-        #print("Timed out")
-        return False
-    ## Start with sleep, just in case the original call has not yet gone through
-    time.sleep(hop)
-    resource = aws_api(**api_params)
+                    expected_value, timeout=30, hop=1, backoff=False):
     keys = nested_jq_path.split(".")
-    for k in keys:
-        resource = resource.get(k)
-    if expected_value == resource:
-        return True
-    else:
-        #print("waiting.." + str(timeout) + " seconds")
-        return wait_over(aws_api, api_params, nested_jq_path,
-                            expected_value, timeout-1, hop)
+    while timeout > 0:
+        sleep = random.uniform(hop/2, hop) if backoff else hop
+        ## Start with sleep, just in case the original call has not yet gone through
+        time.sleep(sleep)
+        resource = aws_api(**api_params)
+        for k in keys:
+            resource = resource.get(k)
+        if expected_value == resource:
+            return True
+        if backoff:
+            timeout -= sleep
+            hop = min(hop*2, MAX_HOP)
+        else:
+            #print("waiting.." + str(timeout) + " seconds")
+            timeout -= 1
+    #print("Timed out")
+    return False
 
 ## Save formatted json data to S3. data is expected to be json string.
 def s3_save(bucket, obj_name, data):
@@ -93,11 +109,11 @@ def all_results( api_name, params, response_key, initial_seed=200):
     next_token=None
     while hasMoreResults:
         if next_token:
-            resp = api_name(**params, maxResults=2, nextToken=next_token)
+            resp = api_name(**params, maxResults=initial_seed, nextToken=next_token)
         else:
-            resp = api_name(**params, maxResults=2)
+            resp = api_name(**params, maxResults=initial_seed)
         result = resp.get(response_key)
-        results = results + result
+        results.extend(result)
         next_token = resp.get('nextToken')
         hasMoreResults = False if not next_token else True
 
@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
-import argparse
-import csv
+import functools
+import io
 import json
 import os
-import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 from library import * ## Common entity construction methods.
 
@@ -21,17 +25,46 @@ output:
     None on console, creates entities in Iottwinmaker workspace
 '''
 
+## Entities of one hierarchy level are created concurrently.
+MAX_WORKERS = 16
+
+## Resources known to exist in the workspace, shared by the worker threads.
+## Both are cleared by import_handler at the start of every import.
+created_component_types = set()
+created_entities = set()
+
+## Keep connections to the service open and pooled for all worker threads.
+CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=30,
+    retries={"mode": "adaptive", "max_attempts": 10})
+
+## Exports above 8 MB are downloaded with concurrent ranged GETs.
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8*1024*1024, max_concurrency=8)
+
+## Clients are built on first use and reused across warm Lambda invocations.
+@functools.lru_cache(maxsize=1)
 def get_iottwinmaker_client():
     #load_env()
-    iottwinmaker = boto3_session().client('iottwinmaker')
+    ## Skip botocore's client side walk over every parameter, the service
+    ## validates requests anyway. Properties are passed through from the
+    ## export unchecked, so malformed ones are only rejected by the service.
+    config = CLIENT_CONFIG.merge(Config(parameter_validation=False))
+    iottwinmaker = boto3_session().client('iottwinmaker', config=config)
     return iottwinmaker
 
+@functools.lru_cache(maxsize=1)
+def get_s3_client():
+    return boto3_session().client('s3', config=CLIENT_CONFIG)
+
 SERVICE_ENDPOINT= os.environ.get('AWS_ENDPOINT')
-s3 = boto3_session().client('s3')
-iottwinmaker_client = get_iottwinmaker_client()
 
 ## -f as the input iottwinmaker json file
 def parse_arguments():
+  ## Only needed from the command line, keep it out of the Lambda cold start.
+  import argparse
   parser = argparse.ArgumentParser(
                   description='Load JSON entities into Iottwinmaker')
   parser.add_argument('-b', '--bucket',
@@ -52,13 +85,13 @@ def parse_arguments():
                         required=False)
   return parser
 
+## Only called from the main thread, before or between submitted levels.
 def create_properties_component(workspace_id, comp_id):
     if not comp_id:
         return
-    cs = iottwinmaker_client.list_component_types(workspaceId = workspace_id)
-    for c in cs.get('componentTypeSummaries'):
-        if comp_id and comp_id == c.get("componentTypeId"):
-            return
+    if comp_id in created_component_types:
+        return
+    iottwinmaker_client = get_iottwinmaker_client()
     resp = iottwinmaker_client.create_component_type(
             workspaceId = workspace_id,
             componentTypeId = comp_id,
@@ -75,14 +108,33 @@ def create_properties_component(workspace_id, comp_id):
     api_report(resp)
     wait_over(iottwinmaker_client.get_component_type,
                 {"componentTypeId":comp_id, "workspaceId":workspace_id},
-                'status.state', 'ACTIVE')
+                'status.state', 'ACTIVE', hop=0.1, backoff=True)
+    created_component_types.add(comp_id)
+
+## List the workspace's component types once, lookups are then served locally.
+def _prime_component_type_cache(workspace_id):
+    iottwinmaker_client = get_iottwinmaker_client()
+    cs = all_results(iottwinmaker_client.list_component_types,
+                     {"workspaceId": workspace_id}, 'componentTypeSummaries')
+    created_component_types.update(c.get("componentTypeId") for c in cs)
+
+## List the workspace's entities once, existence checks then rarely need
+## a get_entity call.
+def _prime_entity_cache(workspace_id):
+    iottwinmaker_client = get_iottwinmaker_client()
+    es = all_results(iottwinmaker_client.list_entities,
+                     {"workspaceId": workspace_id}, 'entitySummaries')
+    created_entities.update(e.get("entityId") for e in es)
+
+def workspace_exists(workspace_id):
+    iottwinmaker_client = get_iottwinmaker_client()
+    ws = all_results(iottwinmaker_client.list_workspaces, {}, 'workspaceSummaries')
+    return any(workspace_id == w.get("workspaceId") for w in ws)
 
 #def create_workspace(workspace_id):
 def create_workspace(workspace_id, iottwinmaker_role_arn):
-    ws = iottwinmaker_client.list_workspaces()
-    for w in ws.get("workspaceSummaries"):
-        if workspace_id == w.get("workspaceId"):
-            return
+    iottwinmaker_client = get_iottwinmaker_client()
+    s3 = get_s3_client()
     bucket_name = "iottwinmaker-" + workspace_id
     s3.create_bucket(Bucket=bucket_name)
     bucket_created = s3.get_waiter('bucket_exists')
@@ -98,8 +150,6 @@ def create_workspace(workspace_id, iottwinmaker_role_arn):
 
 def populate_assets(entity, comp_id, workspace_id):
     create_properties_component(workspace_id, comp_id)
-    description = entity.get("description")
-    assets = entity.get("template_parameters",[])
     properties = entity.get("properties",{})
     components = {
             "attributes": {
@@ -110,23 +160,20 @@ def populate_assets(entity, comp_id, workspace_id):
     return components
 
 def entity_exists(workspace_id, entity_id):
+    if entity_id in created_entities:
+        return True
+    iottwinmaker_client = get_iottwinmaker_client()
     try:
         resp = iottwinmaker_client.get_entity(
             workspaceId = workspace_id,
             entityId = entity_id)
         api_report(resp)
-    except:
+    except iottwinmaker_client.exceptions.ResourceNotFoundException:
         return False
 
+    created_entities.add(entity_id)
     return True
 
-def get_parent_from_input(input_entities, parent_id):
-    for entity in input_entities:
-        if parent_id == entity.get("entity_id"):
-            return entity
-    return None
-
-
 def create_root(root_id, root_name, workspace_id):
     if root_name == '$ROOT':
         root_name = 'ROOT'
@@ -138,70 +185,168 @@ def create_root(root_id, root_name, workspace_id):
     }
 
 
-def create_iottwinmaker_entity(input_entities, entity, workspace_id, comps):
+## check_active waits for the entity to turn ACTIVE, only needed when a
+## later level creates children under it.
+def create_iottwinmaker_entity(entity, workspace_id, comps, check_active=False):
     entity_id = entity.get("entity_id")
     parent_id = entity.get("parent_entity_id")
     entity_name = entity.get("entity_name")
-    parent_name = entity.get("parent_name")
-    comp_id = entity.get("component_type")
     description = entity.get("description") if entity.get("description") else entity_name
 
-    log(f"Processing entity {entity_id}, parent {parent_id}")
+    log("Processing entity %s, parent %s", entity_id, parent_id)
 
-    if entity_exists(workspace_id, entity_id):
+    ## The cache holds every entity listed at startup or created since.
+    if entity_id in created_entities:
         return
 
-    comps = populate_assets(entity, comp_id, workspace_id) if comp_id else comps
-
-    if parent_id is not None:
-        parent_exists = entity_exists(workspace_id, parent_id)
-        if not parent_exists:
-            parent = get_parent_from_input(input_entities, parent_id)
-            if parent is not None:
-                create_iottwinmaker_entity(input_entities, parent, workspace_id, comps)
-            else:
-                root = create_root(parent_id, parent_name, workspace_id)
-                create_entity_api(comps, root, workspace_id)
-    else:
-        parent_id = '$ROOT'
-
+    ## Parents were created in an earlier level or stubbed by root_stubs.
     ntt = { "entityName": entity_name,
         "entityId": entity_id,
-        "parentEntityId": parent_id,
+        "parentEntityId": parent_id or '$ROOT',
         "description": description,
         "workspaceId": workspace_id }
 
-    create_entity_api(comps, ntt, workspace_id)
+    create_entity_api(comps, ntt, workspace_id, check_active)
 
 
-def create_entity_api(comps, ntt, workspace_id):
-    if comps:
-        resp = iottwinmaker_client.create_entity(
-            **ntt, components=comps)
-    else:
-        resp = iottwinmaker_client.create_entity(**ntt)
+def create_entity_api(comps, ntt, workspace_id, check_active=False):
+    iottwinmaker_client = get_iottwinmaker_client()
+    try:
+        if comps:
+            resp = iottwinmaker_client.create_entity(
+                **ntt, components=comps)
+        else:
+            resp = iottwinmaker_client.create_entity(**ntt)
+    except iottwinmaker_client.exceptions.ConflictException:
+        ## Created after the workspace was listed, confirm it really exists.
+        if not entity_exists(workspace_id, ntt.get('entityId')):
+            raise
+        return
     api_report(resp)
-    wait_over(iottwinmaker_client.get_entity,
-              {"entityId": ntt.get('entityId'), "workspaceId": workspace_id},
-              'status.state', 'ACTIVE')
+    if check_active:
+        wait_over(iottwinmaker_client.get_entity,
+                  {"entityId": ntt.get('entityId'), "workspaceId": workspace_id},
+                  'status.state', 'ACTIVE', hop=0.1, backoff=True)
+    created_entities.add(ntt.get('entityId'))
 
 
 def show_entity(entity):
-    log(str(entity))
-
-def process_records(j_data, workspace_id, comp_id):
-    entities = j_data.get("entities")
+    log("%s", entity)
+
+## Kahn traversal grouping entities by depth in the hierarchy, a parent
+## always lands in an earlier level than its children. Raises ValueError
+## when parents form a cycle, self-parented entities included.
+def entity_levels(entities, entity_by_id):
+    children = defaultdict(list)
+    indeg = {}
     for entity in entities:
-        comps = populate_assets(entity, comp_id, workspace_id)
-        #create_iottwinmaker_entity( entity, workspace_id )
-        create_iottwinmaker_entity( entities, entity, workspace_id, comps )
-
-def create_iottwinmaker_entities(j_data, workspace_id, comp_id, iottwinmaker_role_arn):
-    create_workspace(workspace_id, iottwinmaker_role_arn)
-    create_properties_component(workspace_id, comp_id)
-    process_records(j_data, workspace_id, comp_id)
+        entity_id = entity.get("entity_id")
+        parent_id = entity.get("parent_entity_id")
+        if parent_id in entity_by_id:
+            children[parent_id].append(entity)
+            indeg[entity_id] = 1
+        else:
+            indeg[entity_id] = 0
+
+    levels = []
+    level = [e for e in entities if indeg[e.get("entity_id")] == 0]
+    while level:
+        levels.append(level)
+        next_level = []
+        for entity in level:
+            for child in children.pop(entity.get("entity_id"), []):
+                child_id = child.get("entity_id")
+                indeg[child_id] -= 1
+                if indeg[child_id] == 0:
+                    next_level.append(child)
+        level = next_level
+
+    ## Entities in or below a parent cycle never reach an in-degree of zero.
+    leftover = [e.get("entity_id") for e in entities if indeg[e.get("entity_id")] > 0]
+    if leftover:
+        raise ValueError("Entities in or below a parent cycle: " + ", ".join(map(str, leftover)))
+    return levels
+
+## Stubs under the workspace root for parents that are referenced but
+## neither in the input nor in the workspace.
+def root_stubs(entities, entity_by_id, workspace_id):
+    roots = {}
+    for entity in entities:
+        parent_id = entity.get("parent_entity_id")
+        if (not parent_id or parent_id in entity_by_id
+                or parent_id in roots or parent_id in created_entities):
+            continue
+        roots[parent_id] = create_root(parent_id, entity.get("parent_name"), workspace_id)
+    return list(roots.values())
+
+def process_records(levels, roots, workspace_id, comp_id):
+    parent_ids = set(e.get("parent_entity_id") for level in levels for e in level)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(create_entity_api, None, root, workspace_id, True)
+                    for root in roots]
+        for future in as_completed(futures):
+            future.result()
+
+        for level in levels:
+            futures = []
+            for entity in level:
+                ## An entity's own component type wins over the import wide one.
+                comps = populate_assets(
+                    entity, entity.get("component_type") or comp_id, workspace_id)
+                futures.append(executor.submit(
+                    create_iottwinmaker_entity, entity, workspace_id, comps,
+                    entity.get("entity_id") in parent_ids))
+            ## Wait for the whole level before any child references it.
+            for future in as_completed(futures):
+                future.result()
+
+## Leaf entities are not waited on, confirm with one listing that every
+## entity landed. Failed ones are reported, missing ones created again.
+def verify_entities(levels, workspace_id, comp_id):
+    iottwinmaker_client = get_iottwinmaker_client()
+    es = all_results(iottwinmaker_client.list_entities,
+                     {"workspaceId": workspace_id}, 'entitySummaries')
+    states = {e.get("entityId"): e.get("status", {}).get("state") for e in es}
+    missing = []
+    for level in levels:
+        for entity in level:
+            entity_id = entity.get("entity_id")
+            if entity_id not in states:
+                missing.append(entity)
+            elif states[entity_id] == 'ERROR':
+                log("Error: entity %s failed to create", entity_id)
+
+    if missing:
+        log("%d entities missing after import, retrying", len(missing))
+    ## Level order keeps parents ahead of their children.
+    for entity in missing:
+        created_entities.discard(entity.get("entity_id"))
+        comps = populate_assets(
+            entity, entity.get("component_type") or comp_id, workspace_id)
+        create_iottwinmaker_entity(entity, workspace_id, comps, check_active=True)
+
+def prime_workspace_caches(workspace_id):
+    _prime_component_type_cache(workspace_id)
+    _prime_entity_cache(workspace_id)
+
+def create_iottwinmaker_entities(entities, entity_by_id, levels, workspace_id, comp_id):
+    ## Create every component type before any worker runs, so the pool never
+    ## waits on one becoming ACTIVE partway through a level.
+    comp_ids = set(e.get("component_type") or comp_id for e in entities)
+    comp_ids.add(comp_id)
+    for comp in comp_ids:
+        create_properties_component(workspace_id, comp)
+    roots = root_stubs(entities, entity_by_id, workspace_id)
+    process_records(levels, roots, workspace_id, comp_id)
     #process_records(j_data, workspace_id)
-    
+    verify_entities(levels, workspace_id, comp_id)
+
+def load_json(bucket, key):
+    s3 = get_s3_client()
+    buf = io.BytesIO()
+    s3.download_fileobj(bucket, key, buf, Config=TRANSFER_CONFIG)
+    return json.loads(buf.getvalue())
+
 def import_handler(event, context):
     #load_env()
     input = event.get('body')
@@ -210,14 +355,34 @@ def import_handler(event, context):
     workspace_id = input.get("workspaceId")
     connector = input.get("componentTypeId")
     iottwinmaker_role_arn = input.get("iottwinmakerRoleArn")
-    obj_content = s3.get_object(Bucket = json_bucket, Key = json_file)
-    file_content = obj_content['Body'].read().decode('utf-8')
-    json_content = json.loads(file_content)
-    create_iottwinmaker_entities(json_content, workspace_id, connector, iottwinmaker_role_arn)
+    ## Client side validation is off, catch the one required id up front.
+    if not connector:
+        raise ValueError("componentTypeId is required")
+    ## Module state outlives the invocation in a warm container, a cached
+    ## id may belong to another workspace or have been deleted since.
+    created_component_types.clear()
+    created_entities.clear()
+    ## Build both clients up front, a boto3 session is not thread safe.
+    get_iottwinmaker_client()
+    get_s3_client()
+    ## Download the export while the read only workspace lookups run,
+    ## nothing is created until the export has been read and parsed.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        json_content = executor.submit(load_json, json_bucket, json_file)
+        workspace_found = workspace_exists(workspace_id)
+        if workspace_found:
+            prime_workspace_caches(workspace_id)
+        j_data = json_content.result()
+    entities = j_data.get("entities")
+    entity_by_id = {e.get("entity_id"): e for e in entities}
+    ## Parent cycles fail here, before the workspace is touched.
+    levels = entity_levels(entities, entity_by_id)
+    if not workspace_found:
+        create_workspace(workspace_id, iottwinmaker_role_arn)
+        prime_workspace_caches(workspace_id)
+    create_iottwinmaker_entities(entities, entity_by_id, levels, workspace_id, connector)
 
 def main():
-    if __name__ != '__main__':
-        return
     parser = parse_arguments()
     args = parser.parse_args()
 
@@ -229,4 +394,5 @@ def main():
                 'componentTypeId':args.component_type_id,
                 'iottwinmakerRoleArn' : args.iottwinmaker_role_arn}}, None)
 
-main()
+if __name__ == '__main__':
+    main()